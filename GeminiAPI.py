@@ -1,7 +1,17 @@
 import os
+import orjson
+import pikepdf
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
 from io import BytesIO
-import google.generativeai as genai
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from google import genai
+from google.genai import types
 from dotenv import load_dotenv
+from pydantic import BaseModel
 
 # Load API Key
 load_dotenv()
@@ -10,97 +20,414 @@ API_KEY = os.getenv("GEMINI_API_KEY")
 if not API_KEY:
     raise ValueError("❌ GEMINI_API_KEY is missing. Check your .env file.")
 
-genai.configure(api_key=API_KEY)
+client = genai.Client(api_key=API_KEY)
 
+# Flash handles field-level diffing on the common path; Pro is the retry when Flash fails
+DEFAULT_MODEL = "gemini-1.5-flash"
+FALLBACK_MODEL = "gemini-1.5-pro"
 
-def upload_to_gemini(file_stream: BytesIO, filename: str = "uploaded.pdf"):
-    """Uploads a file-like object to Gemini API (in-memory)."""
+# PDFs up to this size are sent inline with the request instead of through the File API.
+# Inline data is base64-encoded and a request is capped at 20MB, so two of these still fit.
+INLINE_PDF_MAX_BYTES = 7 * 1024 * 1024
+
+# PDFs above this size are losslessly recompressed before being sent
+COMPRESS_PDF_MIN_BYTES = 1024 * 1024
+
+# PDFs are compressed and uploaded on a bounded pool, so comparing many files won't flood the API
+MAX_CONCURRENT_UPLOADS = 4
+_upload_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_UPLOADS, thread_name_prefix="gemini-upload")
+
+# Uploaded Gemini files keyed by the SHA-256 of their bytes
+_uploaded_files = {}
+
+# Comparison results keyed by both PDFs and everything sent with them, kept in memory and on disk.
+# Bump RESULT_CACHE_VERSION to invalidate stored results after a change the key can't see.
+RESULT_CACHE_DIR = Path(__file__).parent / ".cache"
+RESULT_CACHE_VERSION = 1
+RESULT_CACHE_MAX_ENTRIES = 32
+_comparison_results = OrderedDict()
+_comparison_results_lock = threading.Lock()
+
+
+# Response schemas, enforced by Gemini's structured output
+class Difference(BaseModel):
+    field: str
+    file1_value: str
+    file2_value: str
+
+
+class LineDifference(BaseModel):
+    item_index: str
+    field: str
+    file1_value: str
+    file2_value: str
+
+
+class Differences(BaseModel):
+    differences: list[Difference]
+
+
+class InvoiceDifferences(BaseModel):
+    header_differences: list[Difference]
+    line_item_differences: list[LineDifference]
+
+
+class InvoiceComparison(BaseModel):
+    differences: InvoiceDifferences
+
+
+# Generation settings are static, so build them once; only the response schema differs
+_GEN_CONFIG = types.GenerateContentConfig(
+    temperature=0.1,  # Lower temperature for more consistent results
+    top_p=1,
+    top_k=1,
+    max_output_tokens=16384,
+    response_mime_type="application/json",
+)
+_DIFFERENCES_CONFIG = _GEN_CONFIG.model_copy(update={"response_schema": Differences})
+_INVOICE_CONFIG = _GEN_CONFIG.model_copy(update={"response_schema": InvoiceComparison})
+
+# Generation settings and response schemas are part of the result cache key
+_OUTPUT_FORMAT_DIGEST = hashlib.sha256(orjson.dumps(
+    [
+        _GEN_CONFIG.model_dump(mode="json", exclude_none=True),
+        Differences.model_json_schema(),
+        InvoiceComparison.model_json_schema(),
+    ],
+    option=orjson.OPT_SORT_KEYS,
+)).hexdigest()
+
+
+def warm_up(model_name=DEFAULT_MODEL):
+    """Makes a cheap token-count call so the connection and auth are ready before the first comparison."""
     try:
-        file = genai.upload_file(
-            file_stream,
-            mime_type="application/pdf",
-            display_name=filename
+        client.models.count_tokens(model=model_name, contents="warmup")
+    except Exception as e:
+        print(f"⚠️ Gemini warm-up failed: {e}")
+
+
+def upload_to_gemini(data: bytes, filename: str = "uploaded.pdf"):
+    """Uploads PDF bytes to Gemini API (in-memory), reusing an earlier upload of the same bytes."""
+    digest = hashlib.sha256(data).hexdigest()
+
+    cached = _uploaded_files.get(digest)
+    if cached is not None:
+        try:
+            # Gemini deletes uploaded files after 48 hours
+            if client.files.get(name=cached.name).state == types.FileState.ACTIVE:
+                print(f"♻️ Reusing upload of '{filename}': {cached.uri}")
+                return cached
+        except Exception:
+            pass
+        # Another worker may have evicted the same stale entry already
+        _uploaded_files.pop(digest, None)
+
+    try:
+        # BytesIO shares the bytes object's buffer rather than copying it
+        file = client.files.upload(
+            file=BytesIO(data),
+            config=types.UploadFileConfig(
+                mime_type="application/pdf",
+                display_name=filename,
+            ),
         )
         print(f"✅ Uploaded file '{filename}' as: {file.uri}")
+        _uploaded_files[digest] = file
         return file
     except Exception as e:
         raise ValueError(f"❌ File upload failed: {e}")
 
 
-def compare_pdfs(file1, file2, doc_type, custom_prompt=None, include_default=False):
-    import json
+def _compress_pdf(data: bytes, filename: str = "uploaded.pdf"):
+    """Recompresses and linearizes a PDF with pikepdf, keeping the original if that doesn't shrink it."""
+    if len(data) <= COMPRESS_PDF_MIN_BYTES:
+        return data
 
-    generation_config = genai.types.GenerationConfig(
-        temperature=0.1,  # Lower temperature for more consistent results
-        top_p=1,
-        top_k=1,
-        max_output_tokens=16384,
-        response_mime_type="application/json",
-    )
+    try:
+        with pikepdf.open(BytesIO(data)) as pdf:
+            out = BytesIO()
+            pdf.save(
+                out,
+                linearize=True,
+                compress_streams=True,
+                object_stream_mode=pikepdf.ObjectStreamMode.generate,
+                deterministic_id=True,  # Same input gives same output, so upload dedupe still hits
+            )
+    except Exception as e:
+        print(f"⚠️ Could not compress '{filename}', sending as is: {e}")
+        return data
+
+    compressed = out.getvalue()
+    if len(compressed) >= len(data):
+        print(f"ℹ️ Compression didn't shrink '{filename}' ({len(data):,} bytes), sending the original")
+        return data
 
-    model = genai.GenerativeModel(
-        model_name="gemini-1.5-pro",
-        generation_config=generation_config,
+    print(f"🗜️ Compressed '{filename}': {len(data):,} → {len(compressed):,} bytes")
+    return compressed
+
+
+def pdf_part(data: bytes, filename: str = "uploaded.pdf"):
+    """Returns PDF bytes as an inline request part, uploading only files too large to send inline."""
+    data = _compress_pdf(data, filename)
+    if len(data) <= INLINE_PDF_MAX_BYTES:
+        return types.Part.from_bytes(data=data, mime_type="application/pdf")
+    return upload_to_gemini(data, filename)
+
+
+async def prepare_pdf_parts(documents):
+    """Turns (bytes, filename) pairs into request parts in parallel on the upload pool."""
+    # Identical PDFs are prepared once, so the same bytes are never uploaded twice at the same time
+    unique = {}
+    for data, filename in documents:
+        unique.setdefault(data, filename)
+
+    loop = asyncio.get_running_loop()
+    parts = await asyncio.gather(
+        *(loop.run_in_executor(_upload_executor, pdf_part, data, filename) for data, filename in unique.items())
     )
+    parts_by_data = dict(zip(unique, parts))
+    return [parts_by_data[data] for data, _ in documents]
 
-    results = {}
 
-    # Get default prompt based on document type
-    default_prompt = get_default_prompt(doc_type)
+class _PartialJsonScanner:
+    """Tracks a streamed JSON reply, scanning only the new text of each chunk.
+
+    feed() returns the reply cut after its last complete array item with the open
+    brackets closed, or None if no new item finished in that chunk.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.broken = False
+
+    def feed(self, text):
+        start = self.length
+        self.chunks.append(text)
+        self.length += len(text)
+        if self.broken:
+            return None
+
+        cut = None
+        for i, ch in enumerate(text, start):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif ch == "\\":
+                    self.escaped = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in "{[":
+                self.stack.append(ch)
+            elif ch in "}]":
+                if not self.stack:
+                    self.broken = True
+                    return None
+                self.stack.pop()
+                # An object just finished inside a list, e.g. one entry of "differences"
+                if ch == "}" and self.stack and self.stack[-1] == "[":
+                    cut = (i + 1, "".join("]" if c == "[" else "}" for c in reversed(self.stack)))
+
+        if cut is None:
+            return None
+        end, closing = cut
+        return self.text()[:end] + closing
+
+    def text(self):
+        return "".join(self.chunks)
+
+
+async def _send_comparison(model_name, config, contents, kind, on_partial=None):
+    """Streams one comparison request from a worker thread, reporting partial results as they arrive."""
+    loop = asyncio.get_running_loop()
+    chunks = asyncio.Queue()
+    # Set when the consumer is done, so an abandoned stream stops instead of running to the end
+    stop = threading.Event()
+
+    def stream():
+        try:
+            for chunk in client.models.generate_content_stream(
+                model=model_name,
+                contents=contents,
+                config=config,
+            ):
+                if stop.is_set():
+                    break
+                if chunk.text:
+                    loop.call_soon_threadsafe(chunks.put_nowait, chunk.text)
+        finally:
+            loop.call_soon_threadsafe(chunks.put_nowait, None)
+
+    producer = asyncio.ensure_future(asyncio.to_thread(stream))
+    try:
+        scanner = _PartialJsonScanner()
+
+        while (text := await chunks.get()) is not None:
+            snapshot = scanner.feed(text)
+            if not snapshot or not on_partial:
+                continue
+            try:
+                partial = orjson.loads(snapshot)
+            except ValueError:
+                continue
+            try:
+                on_partial(kind, partial)
+            except Exception as e:
+                # A failed preview must not fail the comparison or trigger the fallback
+                print(f"⚠️ Could not show partial {kind} results, waiting for the full reply: {e}")
+                on_partial = None
+
+        # Surfaces any error raised while streaming
+        await producer
+        return orjson.loads(scanner.text())
+    except Exception as e:
+        return {
+            "differences": [],
+            "error": f"{kind.capitalize()} prompt error: {str(e)}"
+        }
+    finally:
+        stop.set()
+
+
+async def _with_fallback(send, model_name, kind):
+    """Awaits send(model_name), retrying once on the fallback model if no usable result came back."""
+    result = await send(model_name)
+    if "error" in result and model_name != FALLBACK_MODEL:
+        print(f"⚠️ {kind.capitalize()} comparison failed on {model_name}, retrying with {FALLBACK_MODEL}: "
+              f"{result['error']}")
+        result = await send(FALLBACK_MODEL)
+    return result
+
+
+async def compare_pdfs_async(file1, file2, doc_type, custom_prompt=None, include_default=False,
+                             model_name=DEFAULT_MODEL, on_partial=None):
+    tasks = {}
 
     # Process custom prompt if provided
     if custom_prompt and custom_prompt.strip():
-        try:
-            # Use the custom prompt exactly as entered, but ensure JSON output format
-            prompt_to_use = layman_to_prompt(custom_prompt, doc_type) if custom_prompt else None
-
-            # Fallback to user-entered full prompt if not a layman entry
-            if not prompt_to_use:
-                prompt_to_use = f"""
-                {custom_prompt.strip()}
-
-                Return ONLY JSON in this exact format:
-                {{
-                    "differences": [
-                        {{
-                            "field": "Field Name",
-                            "file1_value": "Value in first file",
-                            "file2_value": "Value in second file"
-                        }}
-                    ]
-                }}
-                If no differences, return: {{ "differences": [] }}
-                """
-
-            chat_session = model.start_chat()
-            response = chat_session.send_message([file1, file2, prompt_to_use])
-            custom_result = json.loads(response.text)
-            results["custom"] = custom_result
-        except Exception as e:
-            results["custom"] = {
-                "differences": [],
-                "error": f"Custom prompt error: {str(e)}"
-            }
+        prompt_to_use = _custom_prompt_text(custom_prompt, doc_type)
+
+        tasks["custom"] = _with_fallback(
+            lambda model: _send_comparison(model, _DIFFERENCES_CONFIG, [file1, file2, prompt_to_use], "custom",
+                                           on_partial),
+            model_name,
+            "custom",
+        )
 
     # If include_default is True or no custom prompt provided, process with default prompt
     if include_default or not custom_prompt or not custom_prompt.strip():
-        try:
-            chat_session = model.start_chat()
-            response = chat_session.send_message([file1, file2, default_prompt])
-            default_result = json.loads(response.text)
-            results["default"] = default_result
-        except Exception as e:
-            results["default"] = {
-                "differences": [],
-                "error": f"Default prompt error: {str(e)}"
-            }
+        # Invoices split differences into header and line-item groups
+        default_config = _INVOICE_CONFIG if doc_type == "Invoices" else _DIFFERENCES_CONFIG
+        default_prompt = get_default_prompt(doc_type)
+
+        tasks["default"] = _with_fallback(
+            lambda model: _send_comparison(model, default_config, [file1, file2, default_prompt], "default",
+                                           on_partial),
+            model_name,
+            "default",
+        )
+
+    # Run the custom and default comparisons concurrently
+    results = dict(zip(tasks.keys(), await asyncio.gather(*tasks.values())))
 
     # If only one result type exists, return just that result
     if len(results) == 1:
-        return json.dumps(list(results.values())[0])
+        return list(results.values())[0]
 
     # Otherwise return both results
-    return json.dumps(results)
+    return results
+
+
+def _custom_prompt_text(custom_prompt, doc_type):
+    """Returns the prompt actually sent for a custom comparison."""
+    # The output format comes from the response schema, so only the fields need describing
+    return layman_to_prompt(custom_prompt, doc_type) or custom_prompt.strip()
+
+
+def _comparison_cache_key(pdf1, pdf2, doc_type, custom_prompt, include_default, model_name):
+    """Builds the result cache key from the PDF bytes and everything sent to Gemini with them."""
+    custom_text = _custom_prompt_text(custom_prompt, doc_type) if custom_prompt and custom_prompt.strip() else ""
+    prompt_settings = "|".join([
+        str(RESULT_CACHE_VERSION),
+        model_name,
+        doc_type,
+        str(include_default),
+        custom_text,
+        get_default_prompt(doc_type),
+    ])
+    parts = [
+        hashlib.sha256(pdf1).hexdigest(),
+        hashlib.sha256(pdf2).hexdigest(),
+        hashlib.sha256(prompt_settings.encode("utf-8")).hexdigest(),
+        _OUTPUT_FORMAT_DIGEST,
+    ]
+    return hashlib.sha256("".join(parts).encode("ascii")).hexdigest()
+
+
+def _remember_result(key, result):
+    # Small LRU shared by all sessions, so the in-memory layer can't grow without bound
+    with _comparison_results_lock:
+        _comparison_results[key] = result
+        _comparison_results.move_to_end(key)
+        while len(_comparison_results) > RESULT_CACHE_MAX_ENTRIES:
+            _comparison_results.popitem(last=False)
+
+
+def _load_cached_result(key):
+    with _comparison_results_lock:
+        if key in _comparison_results:
+            _comparison_results.move_to_end(key)
+            return _comparison_results[key]
+
+    cache_file = RESULT_CACHE_DIR / f"{key}.json"
+    try:
+        with open(cache_file, "rb") as f:
+            result = orjson.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+    _remember_result(key, result)
+    return result
+
+
+def _store_cached_result(key, result):
+    # Don't keep failed comparisons around, they should be retried
+    outcomes = result.values() if "custom" in result and "default" in result else [result]
+    if any("error" in outcome for outcome in outcomes):
+        return
+
+    _remember_result(key, result)
+    try:
+        RESULT_CACHE_DIR.mkdir(exist_ok=True)
+        with open(RESULT_CACHE_DIR / f"{key}.json", "wb") as f:
+            f.write(orjson.dumps(result))
+    except OSError as e:
+        print(f"⚠️ Could not write comparison cache: {e}")
+
+
+async def compare_documents(pdf1, name1, pdf2, name2, doc_type, custom_prompt=None, include_default=False,
+                            model_name=DEFAULT_MODEL, on_partial=None):
+    """Compares two PDFs, returning a cached result when the same inputs were compared before.
+
+    on_partial(kind, result) is called with "custom" or "default" and the differences parsed so far
+    while Gemini is still streaming its reply.
+    """
+    key = _comparison_cache_key(pdf1, pdf2, doc_type, custom_prompt, include_default, model_name)
+    cached = _load_cached_result(key)
+    if cached is not None:
+        print(f"♻️ Reusing cached comparison: {key}")
+        return cached
+
+    file1, file2 = await prepare_pdf_parts([(pdf1, name1), (pdf2, name2)])
+    result = await compare_pdfs_async(file1, file2, doc_type, custom_prompt, include_default, model_name, on_partial)
+
+    _store_cached_result(key, result)
+    return result
 
 
 def layman_to_prompt(user_input, doc_type):
@@ -117,19 +444,8 @@ Please compare the following field(s) in the two invoice documents:
 
 {formatted}
 
-Return only the differences in structured JSON:
-{{
-  "differences": [
-    {{
-      "field": "FIELD_NAME",
-      "file1_value": "value from file 1",
-      "file2_value": "value from file 2"
-    }}
-  ]
-}}
-
-If there are no differences, return:
-{{ "differences": [] }}
+Report only the fields whose values differ, using "file1_value" and "file2_value" for the values found in each document.
+If there are no differences, return an empty "differences" list.
 """
     else:  # Contracts
         return f"""
@@ -137,26 +453,13 @@ Please compare the following field(s) in the two contract documents:
 
 {formatted}
 
-Return only the differences in structured JSON:
-{{
-  "differences": [
-    {{
-      "field": "FIELD_NAME",
-      "file1_value": "value from contract 1",
-      "file2_value": "value from contract 2"
-    }}
-  ]
-}}
-
-If there are no differences, return:
-{{ "differences": [] }}
+Report only the fields whose values differ, using "file1_value" and "file2_value" for the values found in each document.
+If there are no differences, return an empty "differences" list.
 """
 
 
-def get_default_prompt(doc_type):
-    """Returns the default prompt based on document type"""
-    if doc_type == "Invoices":
-        return """
+# Default prompts per document type, built once at import
+_INVOICE_PROMPT = """
     You are given two invoice documents. Extract and compare the following fields for any mismatches:
 
     Header-level fields:
@@ -212,38 +515,12 @@ def get_default_prompt(doc_type):
     - TAX_AMOUNT
     - TAX_PERCENTAGE
 
-    Return the differences as structured JSON in this format:
-    {
-      "differences": {
-        "header_differences": [
-          {
-            "field": "HEADER_FIELD_NAME",
-            "file1_value": "value from file 1",
-            "file2_value": "value from file 2"
-          }
-        ],
-        "line_item_differences": [
-          {
-            "item_index": "1",
-            "field": "LINE_ITEM_FIELD_NAME",
-            "file1_value": "value from file 1",
-            "file2_value": "value from file 2"
-          }
-        ]
-      }
-    }
-
+    Report header differences under "header_differences" and line item differences under
+    "line_item_differences", giving the line number as "item_index".
     If there are no mismatches in a category, return an empty array for that category.
-    If there are no mismatches at all, return:
-    {
-      "differences": {
-        "header_differences": [],
-        "line_item_differences": []
-      }
-    }
     """
-    else:  # For Contracts
-        return """
+
+_CONTRACT_PROMPT = """
     You are given two contract documents. Carefully read and analyze both.
 
     Your task is to extract and compare important legal, financial, and administrative fields. Identify and highlight any differences between the two documents.
@@ -272,16 +549,15 @@ def get_default_prompt(doc_type):
     - Service Level Agreement, Performance Metrics
     - Data Protection, Exclusivity, Non-Compete, Amendment Process
     
-    Return only the differences in the following structured JSON format:
-    
-    ```json
-    {
-      "differences": [
-        {
-          "field": "FIELD_NAME",
-          "file1_value": "value from contract 1",
-          "file2_value": "value from contract 2"
-        }
-      ]
-    }
+    Return only the fields whose values differ between the two contracts.
     """
+
+_DEFAULT_PROMPTS = {
+    "Invoices": _INVOICE_PROMPT,
+    "Contracts": _CONTRACT_PROMPT,
+}
+
+
+def get_default_prompt(doc_type):
+    """Returns the default prompt based on document type"""
+    return _DEFAULT_PROMPTS.get(doc_type, _CONTRACT_PROMPT)
@@ -1,9 +1,11 @@
 import time
-import json
+import asyncio
+import threading
+import orjson
+import numpy as np
 import pandas as pd
 import streamlit as st
-from io import BytesIO
-from GeminiAPI import upload_to_gemini, compare_pdfs, get_default_prompt
+from GeminiAPI import compare_documents, get_default_prompt, warm_up, DEFAULT_MODEL, FALLBACK_MODEL
 
 st.set_page_config(page_title="📄 PDF Document Comparison Tool", layout="wide")
 st.title('📄 PDF Document Comparison Tool')
@@ -18,6 +20,7 @@ def init_session():
         "reset_clicked": False,
         "rescan_clicked": False,
         "download_triggered": False,
+        "warmup_started": False,
     }
     for key, value in defaults.items():
         if key not in st.session_state:
@@ -26,6 +29,11 @@ def init_session():
 
 init_session()
 
+# 🔥 Warm up the Gemini connection in the background while files are being picked
+if not st.session_state.warmup_started:
+    st.session_state.warmup_started = True
+    threading.Thread(target=warm_up, daemon=True).start()
+
 # ✅ Trigger reset after download
 if st.session_state.download_triggered:
     st.session_state.download_triggered = False
@@ -44,6 +52,24 @@ def reset_comparison():
     st.rerun()
 
 
+# Result keys and the column titles they are shown under
+DIFF_COLUMNS = {"field": "Field", "file1_value": "File 1", "file2_value": "File 2"}
+LINE_ITEM_COLUMNS = {"item_index": "Item Index", **DIFF_COLUMNS}
+
+
+def diff_table(diffs, columns):
+    # Build the table column-wise in pandas rather than a dict per row
+    df = pd.DataFrame.from_records(diffs, columns=list(columns)).fillna("")
+    df = df.rename(columns=columns)
+    df.insert(0, "S.No", np.arange(1, len(df) + 1))
+    return df
+
+
+def render_diff_table(diffs, columns, title):
+    st.subheader(f"🔍 {title}:")
+    st.dataframe(diff_table(diffs, columns), use_container_width=True, hide_index=True)
+
+
 def display_results(result_data, doc_type, prefix=""):
     prefix_text = f"{prefix}: " if prefix else ""
 
@@ -59,66 +85,17 @@ def display_results(result_data, doc_type, prefix=""):
 
         # Display header differences if any
         if header_diffs:
-            st.subheader(f"🔍 {prefix_text}Header Differences in {doc_type}:")
-
-            table_data = [
-                {
-                    "S.No": idx + 1,
-                    "Field": item.get("field", ""),
-                    "File 1": item.get("file1_value", ""),
-                    "File 2": item.get("file2_value", "")
-                }
-                for idx, item in enumerate(header_diffs)
-            ]
-            df = pd.DataFrame(table_data)
-
-            def highlight_rows(row):
-                return ['background-color: #F8F9FA' if row.name % 2 == 0 else 'background-color: #FFFFFF'] * len(row)
-
-            st.table(df.style.apply(highlight_rows, axis=1))
+            render_diff_table(header_diffs, DIFF_COLUMNS, f"{prefix_text}Header Differences in {doc_type}")
 
         # Display line item differences if any
         if line_diffs:
-            st.subheader(f"🔍 {prefix_text}Line Item Differences in {doc_type}:")
-
-            table_data = [
-                {
-                    "S.No": idx + 1,
-                    "Item Index": item.get("item_index", ""),
-                    "Field": item.get("field", ""),
-                    "File 1": item.get("file1_value", ""),
-                    "File 2": item.get("file2_value", "")
-                }
-                for idx, item in enumerate(line_diffs)
-            ]
-            df = pd.DataFrame(table_data)
-
-            def highlight_rows(row):
-                return ['background-color: #F8F9FA' if row.name % 2 == 0 else 'background-color: #FFFFFF'] * len(row)
-
-            st.table(df.style.apply(highlight_rows, axis=1))
+            render_diff_table(line_diffs, LINE_ITEM_COLUMNS, f"{prefix_text}Line Item Differences in {doc_type}")
 
     # Original flat structure
     elif result_data.get("differences"):
         # Check if differences is a list (original format)
         if isinstance(result_data["differences"], list):
-            st.subheader(f"🔍 {prefix_text}Found Differences in {doc_type}:")
-
-            table_data = [
-                {
-                    "S.No": idx + 1,
-                    "Field": item.get("field", ""),
-                    "File 1": item.get("file1_value", ""),
-                    "File 2": item.get("file2_value", "")
-                }
-                for idx, item in enumerate(result_data["differences"])
-            ]
-            df = pd.DataFrame(table_data)
-
-            def highlight_rows(row):
-                return ['background-color: #F8F9FA' if row.name % 2 == 0 else 'background-color: #FFFFFF'] * len(row)
-
-            st.table(df.style.apply(highlight_rows, axis=1))
+            render_diff_table(result_data["differences"], DIFF_COLUMNS, f"{prefix_text}Found Differences in {doc_type}")
         else:
             st.error("Unexpected result format. Please check the API response.")
     else:
@@ -148,6 +125,9 @@ include_default = False
 if custom_prompt and custom_prompt.strip():
     include_default = st.toggle("🔄 Also show results from default prompt", value=False)
 
+# Gemini model, Flash by default with Pro as a slower, more thorough option
+model_name = st.selectbox("🤖 Gemini model", (DEFAULT_MODEL, FALLBACK_MODEL))
+
 # Submit button
 submit_clicked = st.button("🚀 Submit for Comparison")
 
@@ -169,11 +149,6 @@ if (
 
         with st.spinner('🔄 Processing files...'):
             try:
-                file1 = upload_to_gemini(BytesIO(st.session_state.uploaded_files[0].read()),
-                                         st.session_state.uploaded_files[0].name)
-                file2 = upload_to_gemini(BytesIO(st.session_state.uploaded_files[1].read()),
-                                         st.session_state.uploaded_files[1].name)
-
                 prompt_expander = st.expander("📄 Prompt Sent to Gemini")
 
                 # Include default in response even when using custom prompt?
@@ -202,8 +177,26 @@ if (
                         st.markdown(f"**Default Prompt for {doc_type}:**")
                         st.markdown(scrollable_box(used_prompt), unsafe_allow_html=True)
 
-                response_text = compare_pdfs(file1, file2, doc_type, custom_prompt, include_default)
-                differences = json.loads(response_text)
+                # Render differences as they stream in, one placeholder per prompt
+                stream_placeholders = {}
+
+                def show_partial(kind, partial_result):
+                    placeholder = stream_placeholders.get(kind)
+                    if placeholder is None:
+                        placeholder = stream_placeholders[kind] = st.empty()
+                    with placeholder.container():
+                        display_results(partial_result, doc_type, f"{kind.capitalize()} Prompt (in progress)")
+
+                # getvalue() returns each upload's own bytes without copying and ignores the read position
+                file1, file2 = st.session_state.uploaded_files
+                differences = asyncio.run(
+                    compare_documents(file1.getvalue(), file1.name, file2.getvalue(), file2.name,
+                                      doc_type, custom_prompt, include_default,
+                                      model_name=model_name, on_partial=show_partial)
+                )
+
+                for placeholder in stream_placeholders.values():
+                    placeholder.empty()
 
                 st.session_state.comparison_result = differences
                 st.session_state.rescan_clicked = False
@@ -238,7 +231,7 @@ if (
         display_results(differences, doc_type, "")
 
     # Download button
-    json_bytes = json.dumps(differences, indent=4).encode("utf-8")
+    json_bytes = orjson.dumps(differences, option=orjson.OPT_INDENT_2)
     if st.download_button(
             label=f"⬇️ Download {doc_type} Differences JSON",
             data=json_bytes,